@@ -1,5 +1,5 @@
 import os
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 
 def read(fname):
@@ -21,6 +21,13 @@ setup(
     packages=[
         package for package in find_packages() if package.startswith("surreal")
     ],
+    ext_modules=[
+        # optional, the pixel wrappers fall back to numba or numpy
+        # when it cannot be built
+        Extension('surreal.env._imgkernels',
+                  sources=['surreal/env/_imgkernels.c'],
+                  optional=True),
+    ],
     entry_points={
         'console_scripts': [
             'surreal-kube=surreal.kube.surreal_kube:main',
@@ -3,6 +3,7 @@ A template class that defines base agent APIs
 """
 import time
 import os
+import numpy as np
 import surreal.utils as U
 from surreal.env import make_env
 from surreal.session import (
@@ -143,6 +144,45 @@ class Agent(object, metaclass=U.AutoInitializeMeta):
         """
         raise NotImplementedError
 
+    def act_batch(self, obs):
+        """
+        Takes actions for a batch of observations coming from a vectorized
+        env (see surreal.env.SyncVectorEnv). Only meant for evaluation.
+        The default implementation calls act() once per env, override it
+        to run a single batched forward pass.
+
+        Args:
+            obs: nested dict of observations with a leading (num_envs,) dim
+
+        Returns:
+            numpy array of actions, one row per env
+        """
+        first_modality = next(iter(obs.values()))
+        num_envs = len(next(iter(first_modality.values())))
+        actions = []
+        for i in range(num_envs):
+            ob = {modality: {key: v[i] for key, v in obs[modality].items()}
+                  for modality in obs}
+            actions.append(self.act(ob))
+        return np.stack(actions)
+
+    def compile_policy(self):
+        """
+        Optionally compiles the policy forward pass used by act_batch(),
+        called once before a long vectorized rollout. No-op by default.
+        """
+        pass
+
+    def reset_batch(self, dones):
+        """
+        Called after a vectorized env step, resets per-env internal states
+        (e.g. RNN hidden states) of the envs that just finished an episode.
+
+        Args:
+            dones: boolean numpy array of (num_envs,)
+        """
+        pass
+
     def module_dict(self):
         """
         Returns:
@@ -79,18 +79,12 @@ class PPOAgent(Agent):
 
         self.pd = DiagGauss(self.action_dim)
         self.cells = None
+        # replaced by a compiled version in compile_policy()
+        self._forward_actor = None
 
         with tx.device_scope(self.gpu_ids):
             if self.rnn_config.if_rnn_policy:
-                # Note that .detach() is necessary here to prevent overflow of memory
-                # otherwise rollout in length of thousands will prevent previously
-                # accumulated hidden/cell states from being freed.
-                self.cells = (torch.zeros(self.rnn_config.rnn_layer,
-                                          1,  # batch_size is 1
-                                          self.rnn_config.rnn_hidden).detach(),
-                              torch.zeros(self.rnn_config.rnn_layer,
-                                          1,  # batch_size is 1
-                                          self.rnn_config.rnn_hidden).detach())
+                self.cells = self._zero_cells(batch_size=1)
 
             self.model = PPOModel(
                 obs_spec=self.obs_spec,
@@ -102,6 +96,7 @@ class PPOAgent(Agent):
                 if_pixel_input=self.env_config.pixel_input,
                 rnn_config=self.rnn_config,
             )
+        self._forward_actor = self.model.forward_actor_expose_cells
 
     def act(self, obs):
         '''
@@ -153,6 +148,49 @@ class PPOAgent(Agent):
                 time.sleep(self.env_config.sleep_time)
                 return action_choice, action_info
 
+    def act_batch(self, obs):
+        '''
+            Batched version of act for evaluation over vectorized envs,
+            runs a single forward pass for all envs. Sampling and clipping
+            are done on the torch side, only the final actions are copied
+            back to numpy.
+            Args:
+                obs: nested dict of numpy arrays of (num_envs, ...)
+
+            Returns:
+                action_choice: numpy array of (num_envs, action_dim)
+        '''
+        with tx.device_scope(self.gpu_ids), torch.no_grad():
+            obs_tensor = {}
+            for mod in obs.keys():
+                obs_tensor[mod] = {}
+                for k in obs[mod].keys():
+                    obs_tensor[mod][k] = torch.tensor(obs[mod][k], dtype=torch.float32)
+                    num_envs = obs_tensor[mod][k].size(0)
+
+            if self.rnn_config.if_rnn_policy and self.cells[0].size(1) != num_envs:
+                self.cells = self._zero_cells(batch_size=num_envs)
+
+            action_pd, self.cells = self._forward_actor(obs_tensor, self.cells)
+            action_choice = action_pd[:, :self.action_dim]
+            if self.agent_mode not in ['eval_deterministic', 'eval_deterministic_local']:
+                action_std = action_pd[:, self.action_dim:] * np.exp(self.noise)
+                action_choice = action_choice + torch.randn_like(action_std) * action_std
+            action_choice = action_choice.clamp(-1, 1)
+            return action_choice.cpu().numpy()
+
+    def compile_policy(self):
+        '''
+            Compiles the actor forward pass used by act_batch with
+            torch.compile (PyTorch 2.0+), no-op on older versions
+        '''
+        if not hasattr(torch, 'compile'):
+            return
+        # CUDA graphs pay off when the policy is launch-bound on GPU
+        mode = 'reduce-overhead' if torch.cuda.is_available() else 'default'
+        self._forward_actor = torch.compile(self.model.forward_actor_expose_cells,
+                                            mode=mode)
+
     def module_dict(self):
         return {
             'ppo': self.model,
@@ -171,16 +209,32 @@ class PPOAgent(Agent):
             reset of LSTM hidden and cell states
         '''
         if self.rnn_config.if_rnn_policy:
-            # Note that .detach() is necessary here to prevent overflow of memory
-            # otherwise rollout in length of thousands will prevent previously
-            # accumulated hidden/cell states from being freed.
             with tx.device_scope(self.gpu_ids):
-                self.cells = (torch.zeros(self.rnn_config.rnn_layer,
-                                          1,  # batch_size is 1
-                                          self.rnn_config.rnn_hidden).detach(),
-                              torch.zeros(self.rnn_config.rnn_layer,
-                                          1,  # batch_size is 1
-                                          self.rnn_config.rnn_hidden).detach())
+                self.cells = self._zero_cells(batch_size=1)
+
+    def reset_batch(self, dones):
+        '''
+            reset of LSTM hidden and cell states of the vectorized envs
+            that just finished an episode
+        '''
+        if self.rnn_config.if_rnn_policy and dones.any():
+            done_ids = torch.from_numpy(np.flatnonzero(dones))
+            for cell in self.cells:
+                cell[:, done_ids] = 0
+
+    def _zero_cells(self, batch_size):
+        '''
+            initial LSTM hidden and cell states for a batch of envs
+        '''
+        # Note that .detach() is necessary here to prevent overflow of memory
+        # otherwise rollout in length of thousands will prevent previously
+        # accumulated hidden/cell states from being freed.
+        return (torch.zeros(self.rnn_config.rnn_layer,
+                            batch_size,
+                            self.rnn_config.rnn_hidden).detach(),
+                torch.zeros(self.rnn_config.rnn_layer,
+                            batch_size,
+                            self.rnn_config.rnn_hidden).detach())
 
     def prepare_env_agent(self, env):
         env = super().prepare_env_agent(env)
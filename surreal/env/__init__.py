@@ -5,4 +5,7 @@ from .exp_sender_wrapper import *
 from .monitor import *
 from .wrapper import *
 from .make_env import make_env, make_env_config
-from .video_env import VideoWrapper
\ No newline at end of file
+from .video_env import VideoWrapper
+from .sync_vector_env import SyncVectorEnv
+from .async_vector_env import AsyncVectorEnv
+from .envpool_adapter import EnvPoolAdapter
@@ -0,0 +1,170 @@
+/*
+ * Optional C kernels for the pixel wrappers in surreal/env/wrapper.py.
+ *
+ * rgb_to_gray(src, dst) writes the BT.601 luma (77 * R + 150 * G + 29 * B) >> 8
+ * of a C-contiguous (H, W, 3) uint8 frame into a C-contiguous (H, W) uint8
+ * array, bit-identical to the numba and numpy versions.
+ *
+ * On x86 CPUs with AVX2 (checked at import time) 16 pixels are converted per
+ * iteration: the interleaved RGB bytes are split into R, G and B with byte
+ * shuffles, widened to 16 bit and combined with 16 bit multiplies. 150 does
+ * not fit in a signed byte, so _mm256_maddubs_epi16 cannot be used.
+ * Other CPUs get the scalar loop.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+
+#if (defined(__x86_64__) || defined(__i386__)) && defined(__GNUC__)
+#define SURREAL_HAVE_AVX2_KERNEL 1
+#include <immintrin.h>
+#endif
+
+static void
+rgb_to_gray_scalar(const uint8_t *rgb, uint8_t *gray, Py_ssize_t n_pixels)
+{
+    Py_ssize_t i;
+    for (i = 0; i < n_pixels; i++) {
+        gray[i] = (uint8_t)((77 * rgb[3 * i]
+                             + 150 * rgb[3 * i + 1]
+                             + 29 * rgb[3 * i + 2]) >> 8);
+    }
+}
+
+#ifdef SURREAL_HAVE_AVX2_KERNEL
+/* shuffle masks picking channel c of 16 pixels out of the 3 consecutive
+ * 16 byte blocks holding them, -1 zeroes the byte */
+static const int8_t SHUFFLE_MASKS[3][3][16] = {
+    {   /* R */
+        {0, 3, 6, 9, 12, 15, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, -1, 2, 5, 8, 11, 14, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 1, 4, 7, 10, 13},
+    },
+    {   /* G */
+        {1, 4, 7, 10, 13, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, 0, 3, 6, 9, 12, 15, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 2, 5, 8, 11, 14},
+    },
+    {   /* B */
+        {2, 5, 8, 11, 14, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, 1, 4, 7, 10, 13, -1, -1, -1, -1, -1, -1},
+        {-1, -1, -1, -1, -1, -1, -1, -1, -1, -1, 0, 3, 6, 9, 12, 15},
+    },
+};
+
+__attribute__((target("avx2")))
+static inline __m256i
+channel_u16(__m128i a, __m128i b, __m128i c, int channel)
+{
+    const int8_t (*masks)[16] = SHUFFLE_MASKS[channel];
+    __m128i bytes = _mm_or_si128(
+        _mm_or_si128(
+            _mm_shuffle_epi8(a, _mm_loadu_si128((const __m128i *)masks[0])),
+            _mm_shuffle_epi8(b, _mm_loadu_si128((const __m128i *)masks[1]))),
+        _mm_shuffle_epi8(c, _mm_loadu_si128((const __m128i *)masks[2])));
+    return _mm256_cvtepu8_epi16(bytes);
+}
+
+__attribute__((target("avx2")))
+static void
+rgb_to_gray_avx2(const uint8_t *rgb, uint8_t *gray, Py_ssize_t n_pixels)
+{
+    const __m256i coef_r = _mm256_set1_epi16(77);
+    const __m256i coef_g = _mm256_set1_epi16(150);
+    const __m256i coef_b = _mm256_set1_epi16(29);
+    Py_ssize_t i = 0;
+    for (; i + 16 <= n_pixels; i += 16) {
+        const uint8_t *p = rgb + 3 * i;
+        __m128i a = _mm_loadu_si128((const __m128i *)p);
+        __m128i b = _mm_loadu_si128((const __m128i *)(p + 16));
+        __m128i c = _mm_loadu_si128((const __m128i *)(p + 32));
+        /* at most 256 * 255, no uint16 overflow */
+        __m256i luma = _mm256_add_epi16(
+            _mm256_add_epi16(
+                _mm256_mullo_epi16(channel_u16(a, b, c, 0), coef_r),
+                _mm256_mullo_epi16(channel_u16(a, b, c, 1), coef_g)),
+            _mm256_mullo_epi16(channel_u16(a, b, c, 2), coef_b));
+        luma = _mm256_srli_epi16(luma, 8);
+        __m128i packed = _mm_packus_epi16(_mm256_castsi256_si128(luma),
+                                          _mm256_extracti128_si256(luma, 1));
+        _mm_storeu_si128((__m128i *)(gray + i), packed);
+    }
+    rgb_to_gray_scalar(rgb + 3 * i, gray + i, n_pixels - i);
+}
+#endif
+
+static void (*rgb_to_gray_impl)(const uint8_t *, uint8_t *, Py_ssize_t) =
+    rgb_to_gray_scalar;
+
+static PyObject *
+rgb_to_gray(PyObject *self, PyObject *args)
+{
+    PyObject *src_obj, *dst_obj;
+    Py_buffer src, dst;
+
+    if (!PyArg_ParseTuple(args, "OO:rgb_to_gray", &src_obj, &dst_obj))
+        return NULL;
+    if (PyObject_GetBuffer(src_obj, &src, PyBUF_C_CONTIGUOUS) < 0)
+        return NULL;
+    if (PyObject_GetBuffer(dst_obj, &dst, PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE) < 0) {
+        PyBuffer_Release(&src);
+        return NULL;
+    }
+    if (src.itemsize != 1 || dst.itemsize != 1) {
+        PyErr_SetString(PyExc_ValueError, "rgb_to_gray: expected uint8 arrays");
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&dst);
+        return NULL;
+    }
+    if (src.len != 3 * dst.len) {
+        PyErr_Format(PyExc_ValueError,
+                     "rgb_to_gray: source has %zd bytes, expected 3 * %zd",
+                     src.len, dst.len);
+        PyBuffer_Release(&src);
+        PyBuffer_Release(&dst);
+        return NULL;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    rgb_to_gray_impl((const uint8_t *)src.buf, (uint8_t *)dst.buf, dst.len);
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&src);
+    PyBuffer_Release(&dst);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef imgkernels_methods[] = {
+    {"rgb_to_gray", rgb_to_gray, METH_VARARGS,
+     "rgb_to_gray(src, dst)\n\n"
+     "Writes the luma (77 * R + 150 * G + 29 * B) >> 8 of the C-contiguous\n"
+     "(H, W, 3) uint8 array src into the C-contiguous (H, W) uint8 array dst."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef imgkernels_module = {
+    PyModuleDef_HEAD_INIT,
+    "_imgkernels",
+    "Optional C kernels for the pixel wrappers",
+    -1,
+    imgkernels_methods
+};
+
+PyMODINIT_FUNC
+PyInit__imgkernels(void)
+{
+    PyObject *module = PyModule_Create(&imgkernels_module);
+    int avx2 = 0;
+    if (module == NULL)
+        return NULL;
+#ifdef SURREAL_HAVE_AVX2_KERNEL
+    __builtin_cpu_init();
+    if (__builtin_cpu_supports("avx2")) {
+        rgb_to_gray_impl = rgb_to_gray_avx2;
+        avx2 = 1;
+    }
+#endif
+    if (PyModule_AddIntConstant(module, "AVX2", avx2) < 0) {
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
+}
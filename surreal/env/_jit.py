@@ -0,0 +1,84 @@
+"""
+Per-step pixel kernels, compiled with numba when it is installed.
+numba is only imported by load(), the first time a pixel wrapper is
+built, so that processes without pixel observations do not pay for it.
+Callers fall back to numpy code when load() returns None.
+"""
+import types
+import numpy as np
+
+# None until load() is called, False if numba is not installed
+_kernels = None
+
+
+def load():
+    """
+    Returns a namespace with the numba compiled grayscale, stack_frames
+    and gray_and_stack, or None if numba is not installed
+    """
+    global _kernels
+    if _kernels is None:
+        try:
+            from numba import njit
+        except ImportError:
+            _kernels = False
+        else:
+            _kernels = types.SimpleNamespace(
+                grayscale=njit(cache=True, fastmath=True)(grayscale),
+                stack_frames=njit(cache=True)(stack_frames),
+                gray_and_stack=njit(cache=True, fastmath=True)(gray_and_stack),
+            )
+    return _kernels or None
+
+
+def grayscale(frame, out):
+    """
+    Writes the BT.601 luma (77 * R + 150 * G + 29 * B) >> 8 of a (3, H, W)
+    uint8 frame into the (H, W) uint8 array out
+    """
+    H, W = out.shape
+    for h in range(H):
+        for w in range(W):
+            out[h, w] = (77 * np.int32(frame[0, h, w])
+                         + 150 * np.int32(frame[1, h, w])
+                         + 29 * np.int32(frame[2, h, w])) >> 8
+
+
+def stack_frames(frame, ring, write_idx, out):
+    """
+    Stores frame in slot write_idx of the ring buffer holding the last n
+    frames, then copies the n frames from oldest to newest into out
+
+    Args:
+        frame: (C, H, W) array
+        ring: (n, C, H, W) array
+        write_idx: slot of the newest frame
+        out: (n, C, H, W) array
+    """
+    n = ring.shape[0]
+    ring[write_idx] = frame
+    for i in range(n):
+        out[i] = ring[(write_idx + 1 + i) % n]
+
+
+def gray_and_stack(frame, ring, write_idx, out):
+    """
+    Fused grayscale + frame stacking in a single pass over the frame.
+    Writes the luma (77 * R + 150 * G + 29 * B) >> 8 of frame into slot
+    write_idx of the ring buffer holding the last n grayscale frames, then
+    copies the n frames from oldest to newest into out
+
+    Args:
+        frame: (H, W, 3) uint8 array, as rendered
+        ring: (n, H, W) uint8 array
+        write_idx: slot of the newest frame
+        out: (n, H, W) uint8 array
+    """
+    n, H, W = ring.shape
+    for h in range(H):
+        for w in range(W):
+            ring[write_idx, h, w] = (77 * np.int32(frame[h, w, 0])
+                                     + 150 * np.int32(frame[h, w, 1])
+                                     + 29 * np.int32(frame[h, w, 2])) >> 8
+    for i in range(n):
+        out[i] = ring[(write_idx + 1 + i) % n]
@@ -0,0 +1,297 @@
+"""
+Steps several copies of an environment in parallel worker processes
+"""
+import collections
+import traceback
+import numpy as np
+from multiprocessing import Process, Pipe
+import surreal.utils as U
+from .base import Env
+from .sync_vector_env import obs_dtype
+
+
+def _shared_obs(obs_spec, num_envs, shms):
+    """
+    Creates numpy views of shape (num_envs, ...) on top of one shared
+    memory block per observation key.
+
+    Args:
+        obs_spec: observation spec of a single env
+        num_envs: total number of envs
+        shms: dict of (modality, key) -> SharedMemory
+
+    Returns:
+        nested dict of observations backed by shared memory
+    """
+    obs = collections.OrderedDict()
+    for modality in obs_spec:
+        modality_views = collections.OrderedDict()
+        for key, shape in obs_spec[modality].items():
+            modality_views[key] = np.ndarray((num_envs,) + tuple(shape),
+                                             dtype=obs_dtype(modality),
+                                             buffer=shms[modality, key].buf)
+        obs[modality] = modality_views
+    return obs
+
+
+def _shared_results(num_envs, shms):
+    """
+    Creates the (num_envs,) rewards and dones arrays on top of their
+    shared memory blocks
+    """
+    rewards = np.ndarray((num_envs,), dtype=np.float32, buffer=shms['rewards'].buf)
+    dones = np.ndarray((num_envs,), dtype=np.bool_, buffer=shms['dones'].buf)
+    return rewards, dones
+
+
+class Worker(Process):
+    '''
+    Process that owns a group of envs. On every command from the
+    AsyncVectorEnv it steps (or resets) all of them, writes their
+    observations, rewards and dones into its slice of the shared memory
+    buffers and sends back only the infos.
+    '''
+    def __init__(self, env_fns, start_index, num_envs, obs_spec, shm_names, pipe, parent_pipe):
+        '''
+        Args:
+            env_fns: callables that each return a (wrapped) env
+            start_index: index of the first env of this worker in the batch
+            num_envs: total number of envs of the AsyncVectorEnv
+            obs_spec: observation spec of a single env
+            shm_names: dict of (modality, key), 'rewards' and 'dones'
+                -> name of the SharedMemory
+            pipe: worker end of the command pipe
+            parent_pipe: parent end of the command pipe, closed in the worker
+        '''
+        super().__init__(daemon=True)
+        self.env_fns = env_fns
+        self.start_index = start_index
+        self.num_envs = num_envs
+        self.obs_spec = obs_spec
+        self.shm_names = shm_names
+        self.pipe = pipe
+        self.parent_pipe = parent_pipe
+
+    def _write_obs(self, i, obs):
+        for modality, modality_views in self._obs.items():
+            for key, view in modality_views.items():
+                view[self.start_index + i] = obs[modality][key]
+
+    def _reset(self):
+        infos = []
+        for i, env in enumerate(self.envs):
+            obs, info = env.reset()
+            self._write_obs(i, obs)
+            infos.append(info)
+        return infos
+
+    def _step(self, actions):
+        infos = []
+        for i, env in enumerate(self.envs):
+            obs, reward, done, info = env.step(actions[i])
+            if done:
+                obs, _ = env.reset()
+            self._write_obs(i, obs)
+            self._rewards[self.start_index + i] = reward
+            self._dones[self.start_index + i] = done
+            infos.append(info)
+        return infos
+
+    def run(self):
+        from multiprocessing.shared_memory import SharedMemory
+        self.parent_pipe.close()
+        shms = {k: SharedMemory(name=name) for k, name in self.shm_names.items()}
+        self._obs = _shared_obs(self.obs_spec, self.num_envs, shms)
+        self._rewards, self._dones = _shared_results(self.num_envs, shms)
+        self.envs = []
+        try:
+            self.envs = [env_fn() for env_fn in self.env_fns]
+            self.pipe.send((True, None))
+            while True:
+                command, data = self.pipe.recv()
+                if command == 'step':
+                    self.pipe.send((True, self._step(data)))
+                elif command == 'reset':
+                    self.pipe.send((True, self._reset()))
+                elif command == 'close':
+                    break
+                else:
+                    raise ValueError('Unknown command: {}'.format(command))
+        except (KeyboardInterrupt, EOFError):
+            pass
+        except Exception:
+            self.pipe.send((False, traceback.format_exc()))
+        finally:
+            for env in self.envs:
+                env.close()
+            # views must be released before the buffers can be closed
+            self._obs = self._rewards = self._dones = None
+            for shm in shms.values():
+                shm.close()
+            self.pipe.close()
+
+
+class AsyncVectorEnv(Env):
+    '''
+    Runs N copies of an environment in worker processes so that the
+    simulators step in parallel while the agent computes its actions.
+
+    Envs are grouped so that each worker process owns `envs_per_process`
+    of them, every pipe message then carries the results of a whole group.
+    Observations are not sent through the pipes: each (modality, key) gets
+    one shared memory block of shape (N, ...) that the workers write into
+    directly, as do the rewards and dones. Only actions and infos go
+    through the pipes.
+
+    The interface matches SyncVectorEnv: observations come in the nested
+    modality -> key -> array format with a leading (N,) dimension, and
+    sub-envs that finish an episode are reset automatically.
+
+    Reuse contract: the observation, rewards and dones arrays are views of
+    the shared memory and the same objects are returned by every
+    reset()/step(), overwritten in place. Copy them before the next
+    step() if they need to be kept (e.g. in a replay buffer), and do not
+    write into them.
+
+    Note: env_fns are sent to the workers as is, which requires the fork
+    start method (default on Linux) when they are lambdas.
+    Requires Python 3.8+ for multiprocessing.shared_memory, imported when
+    the env is created so that importing surreal.env works on older versions
+
+    Attributes:
+        num_envs: number of environments
+        num_processes: number of worker processes
+    '''
+    def __init__(self, env_fns, obs_spec, envs_per_process=1):
+        '''
+        Args:
+            env_fns: list of callables that each return a (wrapped) env
+            obs_spec: observation spec of a single env, e.g. env_config.obs_spec
+                Used to size the shared buffers without creating an env
+                in the parent process
+            envs_per_process: number of envs stepped by each worker
+        '''
+        # set before anything can fail, _close() is called on failure
+        # and by __del__
+        self._closed_workers = False
+        self._shms = {}
+        self._slices = []
+        self._pipes = []
+        self._workers = []
+
+        self.num_envs = len(env_fns)
+        assert self.num_envs > 0, 'AsyncVectorEnv needs at least one env'
+        assert envs_per_process >= 1
+        self.num_processes = U.ceildiv(self.num_envs, envs_per_process)
+        self.envs_per_process = envs_per_process
+        self._obs_spec = obs_spec
+        try:
+            self._start_workers(env_fns, obs_spec, envs_per_process)
+        except BaseException:
+            # release the shared memory and the workers started so far
+            self._close()
+            raise
+
+    def _start_workers(self, env_fns, obs_spec, envs_per_process):
+        from multiprocessing.shared_memory import SharedMemory
+        for modality in obs_spec:
+            for key, shape in obs_spec[modality].items():
+                nbytes = (self.num_envs * int(np.prod(shape))
+                          * np.dtype(obs_dtype(modality)).itemsize)
+                self._shms[modality, key] = SharedMemory(create=True, size=max(nbytes, 1))
+        self._shms['rewards'] = SharedMemory(
+            create=True, size=self.num_envs * np.dtype(np.float32).itemsize)
+        self._shms['dones'] = SharedMemory(
+            create=True, size=self.num_envs * np.dtype(np.bool_).itemsize)
+        self._obs = _shared_obs(obs_spec, self.num_envs, self._shms)
+        self._rewards, self._dones = _shared_results(self.num_envs, self._shms)
+        shm_names = {k: shm.name for k, shm in self._shms.items()}
+
+        for start in range(0, self.num_envs, envs_per_process):
+            end = min(start + envs_per_process, self.num_envs)
+            parent_pipe, worker_pipe = Pipe()
+            worker = Worker(env_fns[start:end], start, self.num_envs,
+                            obs_spec, shm_names, worker_pipe, parent_pipe)
+            worker.start()
+            worker_pipe.close()
+            self._slices.append(slice(start, end))
+            self._pipes.append(parent_pipe)
+            self._workers.append(worker)
+        for pipe in self._pipes:
+            self._recv(pipe)
+
+    def _recv(self, pipe):
+        success, data = pipe.recv()
+        if not success:
+            raise RuntimeError('AsyncVectorEnv worker failed:\n{}'.format(data))
+        return data
+
+    def reset_async(self):
+        for pipe in self._pipes:
+            pipe.send(('reset', None))
+
+    def reset_wait(self):
+        infos = []
+        for pipe in self._pipes:
+            infos.extend(self._recv(pipe))
+        return self._obs, infos
+
+    def step_async(self, actions):
+        '''
+        Sends the actions to the workers without waiting for the results,
+        the caller can do other work before calling step_wait()
+
+        Args:
+            actions: array of shape (N, action_dim)
+        '''
+        for pipe, env_slice in zip(self._pipes, self._slices):
+            pipe.send(('step', actions[env_slice]))
+
+    def step_wait(self):
+        '''
+        Returns:
+            obs: nested dict of batched observations
+            rewards: numpy array of (N,)
+            dones: boolean numpy array of (N,)
+            infos: list of N info dicts
+            obs, rewards and dones are reused across steps, see the class
+            docstring
+        '''
+        infos = []
+        for pipe in self._pipes:
+            infos.extend(self._recv(pipe))
+        return self._obs, self._rewards, self._dones, infos
+
+    def _reset(self):
+        self.reset_async()
+        return self.reset_wait()
+
+    def _step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def _close(self):
+        if self._closed_workers:
+            return
+        self._closed_workers = True
+        for pipe in self._pipes:
+            try:
+                pipe.send(('close', None))
+            except (BrokenPipeError, EOFError):
+                pass
+        for worker in self._workers:
+            worker.join()
+        for pipe in self._pipes:
+            pipe.close()
+        # views must be released before the buffers can be closed
+        self._obs = self._rewards = self._dones = None
+        for shm in self._shms.values():
+            shm.close()
+            shm.unlink()
+
+    def observation_spec(self):
+        return self._obs_spec
+
+    def __str__(self):
+        return '<{}{}x{}>'.format(type(self).__name__,
+                                  self.num_processes, self.envs_per_process)
@@ -1,8 +1,6 @@
 import numpy as np
-import sys
 import collections
 import dm_control
-from dm_control.suite.wrappers import pixels
 from dm_control.rl.environment import StepType
 from .wrapper import Wrapper, SpecFormat
 from .base import ActionType
@@ -21,12 +19,16 @@ class DMControlDummyWrapper(Wrapper):
         # dm_control envs don't have metadata
         env.metadata = {}
         super().__init__(env)
+        self._obs_spec_cached = self._make_observation_spec()
 
     @property
     def spec_format(self):
         return SpecFormat.DM_CONTROL
 
     def observation_spec(self):
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
         modality = collections.OrderedDict([('pixels', dm_control.rl.specs.ArraySpec(shape=(84, 84, 3), dtype=np.dtype('float32')))])
         return modality
 
@@ -35,6 +37,7 @@ class DMControlDummyWrapper(Wrapper):
 
 class DMControlAdapter(Wrapper):
     def __init__(self, env, is_pixel_input):
+        from dm_control.suite.wrappers import pixels
         # dm_control envs don't have metadata
         env.metadata = {}
         super().__init__(env)
@@ -43,6 +46,8 @@ class DMControlAdapter(Wrapper):
         assert (isinstance(env, dm_control.rl.control.Environment) or
             isinstance(env, pixels.Wrapper) or
             isinstance(env, DMControlDummyWrapper))
+        self._obs_spec_cached = self._make_observation_spec()
+        self._action_spec_cached = self._make_action_spec()
 
     def _add_modality(self, obs):
         if self.is_pixel_input:
@@ -72,6 +77,9 @@ class DMControlAdapter(Wrapper):
         return SpecFormat.SpecFormat.DM_CONTROL
 
     def observation_spec(self):
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
         obs_spec = collections.OrderedDict()
         for modality, v in self._add_modality(self.env.observation_spec()).items():
             modality_spec = collections.OrderedDict()
@@ -82,21 +90,22 @@ class DMControlAdapter(Wrapper):
         return obs_spec
 
     def action_spec(self):
+        return self._action_spec_cached
+
+    def _make_action_spec(self):
         return {
             'type': ActionType.continuous,
             'dim': self.env.action_spec().shape, # DM_control returns int, we want all dim to be tuple
         }
 
     def _render(self, *args, width=480, height=480, camera_id=1, **kwargs):
-        # safe for multiple calls
+        # only needed when rendering, keeps SDL out of headless processes
+        import sys
         import pygame
-        pygame.init()
-        if not self.screen:
+        if self.screen is None or self.screen.get_size() != (width, height):
+            # only needed when the window is (re)created
+            pygame.init()
             self.screen = pygame.display.set_mode((width, height))
-        else:
-            c_width, c_height = self.screen.get_size()
-            if c_width != width or c_height != height:
-                self.screen = pygame.display.set_mode((width, height))
         for event in pygame.event.get():
             if event.type == pygame.QUIT: sys.exit()
 
@@ -0,0 +1,144 @@
+"""
+Runs dm_control tasks in envpool's C++ thread pool
+"""
+import collections
+import re
+import numpy as np
+from .base import Env, ActionType
+
+
+def envpool_task_id(env_name):
+    """
+    Converts a surreal dm_control env name to an envpool task id,
+    e.g. 'dm_control:cheetah-run' -> 'CheetahRun-v1'
+    """
+    env_category, env_name = env_name.split(':')
+    if env_category != 'dm_control':
+        raise ValueError('envpool is only supported for dm_control envs, '
+                         'got {}'.format(env_category))
+    parts = re.split('[-_]', env_name)
+    return ''.join(part.capitalize() for part in parts) + '-v1'
+
+
+def _fields(observation):
+    # envpool returns observations and specs as namedtuples
+    if hasattr(observation, '_asdict'):
+        return observation._asdict()
+    return observation
+
+
+class EnvPoolAdapter(Env):
+    '''
+    Steps N copies of a dm_control task inside envpool, so that all
+    MuJoCo steps of a batch happen in C++ threads without the GIL.
+
+    Produces what SyncVectorEnv over make_env(env_config) produces for
+    low dimensional dm_control envs: the low_dim observations allowed by
+    env_config.observation are concatenated into 'flat_inputs', with a
+    leading (N,) dimension. Pixel input is not supported, use
+    SyncVectorEnv or AsyncVectorEnv for those.
+
+    Differences with SyncVectorEnv:
+    - sub-envs that finish an episode are reset by envpool on the next
+      step() call, which ignores their action and returns the first
+      observation of the new episode with reward 0
+    - the wrappers applied by make_env and Agent.prepare_env (e.g.
+      MaxStepWrapper) are bypassed
+
+    The same observation, rewards and dones arrays are returned by every
+    reset()/step() and overwritten in place. Copy them before the next
+    step() if they need to be kept.
+
+    Attributes:
+        num_envs: number of environments
+        flat_keys: (key, size) of the observations concatenated into
+            'flat_inputs', in order
+    '''
+    def __init__(self, env_config, num_envs):
+        '''
+        Args:
+            env_config: env config with a 'dm_control:<domain>-<task>' env_name
+            num_envs: number of environments stepped in parallel
+        '''
+        # set first, _close() is called by __del__ even if __init__ fails
+        self.env = None
+        if env_config.pixel_input:
+            raise ValueError('EnvPoolAdapter does not support pixel input')
+        import envpool
+        self.num_envs = num_envs
+        self.metadata = {}
+        self.task_id = envpool_task_id(env_config.env_name)
+        self.env = envpool.make(self.task_id,
+                                env_type='dm',
+                                num_envs=num_envs)
+        allowed_keys = env_config.observation['low_dim']
+        # (key, start, end) of every observation in the concatenated vector,
+        # in envpool's order which can differ from the order make_env
+        # concatenates them in, compare flat_keys before mixing the two
+        self._flat_slices = []
+        self.flat_keys = []
+        flat_dim = 0
+        for key, spec in _fields(self.env.observation_spec()).items():
+            if key not in allowed_keys:
+                continue
+            size = int(np.prod(spec.shape))
+            self._flat_slices.append((key, flat_dim, flat_dim + size))
+            self.flat_keys.append((key, size))
+            flat_dim += size
+        self._flat_dim = flat_dim
+        self._obs = collections.OrderedDict([
+            ('low_dim', collections.OrderedDict([
+                ('flat_inputs', np.empty((num_envs, flat_dim), dtype=np.float32))
+            ]))
+        ])
+        self._rewards = np.empty(num_envs, dtype=np.float32)
+        self._dones = np.empty(num_envs, dtype=np.bool_)
+        self._action_dim = self.env.action_spec().shape
+
+    def _write_obs(self, timestep):
+        flat_inputs = self._obs['low_dim']['flat_inputs']
+        observation = _fields(timestep.observation)
+        for key, start, end in self._flat_slices:
+            flat_inputs[:, start:end] = observation[key].reshape(self.num_envs, -1)
+
+    def _reset(self):
+        timestep = self.env.reset()
+        self._write_obs(timestep)
+        return self._obs, [{} for _ in range(self.num_envs)]
+
+    def _step(self, actions):
+        '''
+        Args:
+            actions: array of shape (N, action_dim)
+
+        Returns:
+            obs: nested dict of batched observations
+            rewards: numpy array of (N,)
+            dones: boolean numpy array of (N,)
+            infos: list of N info dicts
+        '''
+        timestep = self.env.step(np.asarray(actions))
+        self._write_obs(timestep)
+        self._rewards[:] = timestep.reward
+        # dm_env has no reward on the first step of an episode
+        np.nan_to_num(self._rewards, copy=False)
+        self._dones[:] = timestep.last()
+        return self._obs, self._rewards, self._dones, [{} for _ in range(self.num_envs)]
+
+    def _close(self):
+        if self.env is not None:
+            self.env.close()
+
+    def observation_spec(self):
+        return collections.OrderedDict([
+            ('low_dim', collections.OrderedDict([('flat_inputs', (self._flat_dim,))]))
+        ])
+
+    def action_spec(self):
+        return {
+            'type': ActionType.continuous,
+            'dim': self._action_dim,
+        }
+
+    def __str__(self):
+        return '<{}{}x{}>'.format(type(self).__name__, self.num_envs, self.task_id)
@@ -7,6 +7,7 @@ from .wrapper import (
     FrameStackWrapper,
     GrayscaleWrapper,
     TransposeWrapper,
+    FusedPixelPipeline,
     FilterWrapper,
     ObservationConcatenationWrapper,
     RobosuiteWrapper
@@ -61,6 +62,24 @@ def make_env(env_config, mode=None):
     return env, env_config
 
 
+def use_fused_pixel_pipeline(env_config):
+    """
+    Whether FusedPixelPipeline can replace the separate
+    Transpose/Grayscale/FrameStack wrappers. Configs saved before
+    use_fused_pixel_pipeline existed get the fused pipeline.
+    """
+    return (env_config.get('use_fused_pixel_pipeline', True)
+            and env_config.frame_stack_concatenate_on_env)
+
+
+def flat_obs_dtype(env_config):
+    """
+    dtype of the concatenated low_dim observations, float32 for configs
+    saved before flat_obs_dtype existed
+    """
+    return env_config.get('flat_obs_dtype', 'float32')
+
+
 def make_gym(env_name, env_config):
     import gym
     env = gym.make(env_name)
@@ -91,13 +110,17 @@ def make_robosuite(env_name, env_config):
     )
     env = RobosuiteWrapper(env, env_config)
     env = FilterWrapper(env, env_config)
-    env = ObservationConcatenationWrapper(env)
+    env = ObservationConcatenationWrapper(env, dtype=flat_obs_dtype(env_config))
     if env_config.pixel_input:
-        env = TransposeWrapper(env)
-        if env_config.use_grayscale:
-            env = GrayscaleWrapper(env)
-        if env_config.frame_stacks:
-            env = FrameStackWrapper(env, env_config)
+        if (env_config.use_grayscale and env_config.frame_stacks
+                and use_fused_pixel_pipeline(env_config)):
+            env = FusedPixelPipeline(env, env_config)
+        else:
+            env = TransposeWrapper(env)
+            if env_config.use_grayscale:
+                env = GrayscaleWrapper(env)
+            if env_config.frame_stacks:
+                env = FrameStackWrapper(env, env_config)
     env_config.action_spec = env.action_spec()
     env_config.obs_spec = env.observation_spec()
     return env, env_config
@@ -125,12 +148,15 @@ def make_dm_control(env_name, env_config):
     # env = suite.load(domain_name=domain_name, task_name=task_name, visualize_reward=record_video)
     env = DMControlAdapter(env, pixel_input)
     env = FilterWrapper(env, env_config)
-    env = ObservationConcatenationWrapper(env)
+    env = ObservationConcatenationWrapper(env, dtype=flat_obs_dtype(env_config))
     if pixel_input:
-        env = TransposeWrapper(env)
-        env = GrayscaleWrapper(env)
-        if env_config.frame_stacks > 1:
-            env = FrameStackWrapper(env, env_config)
+        if env_config.frame_stacks > 1 and use_fused_pixel_pipeline(env_config):
+            env = FusedPixelPipeline(env, env_config)
+        else:
+            env = TransposeWrapper(env)
+            env = GrayscaleWrapper(env)
+            if env_config.frame_stacks > 1:
+                env = FrameStackWrapper(env, env_config)
     env_config.action_spec = env.action_spec()
     env_config.obs_spec = env.observation_spec()
     return env, env_config
@@ -0,0 +1,114 @@
+"""
+Steps several copies of an environment in lockstep in a single process
+"""
+import collections
+import numpy as np
+from .base import Env
+
+
+def obs_dtype(modality):
+    """
+    dtype of the batched observation buffers of a modality
+    """
+    # pixel observations stay uint8, the rest is fed to the
+    # network as float32 anyways
+    return np.uint8 if modality == 'pixel' else np.float32
+
+
+class SyncVectorEnv(Env):
+    '''
+    Batches N copies of an environment so that an agent can run one
+    forward pass per step for all of them.
+
+    Observations are returned in the same nested format as the wrapped
+    envs (modality -> key -> array), with every array gaining a leading
+    (N,) dimension. The batched arrays are preallocated from the
+    observation spec and each sub-env writes into its own slot, so no
+    per-step concatenation takes place. Sub-envs that finish an episode
+    are reset automatically; the returned observation for that slot is
+    then the first observation of the new episode.
+
+    Reuse contract: the same observation, rewards and dones arrays are
+    returned by every reset()/step() and overwritten in place. Copy them
+    before the next step() if they need to be kept.
+
+    Note: requires frame stacks to be concatenated on env
+    (env_config.frame_stack_concatenate_on_env)
+
+    Attributes:
+        envs: list of the wrapped environments
+        num_envs: number of environments
+    '''
+    def __init__(self, env_fns):
+        '''
+        Args:
+            env_fns: list of callables that each return a (wrapped) env
+        '''
+        self.envs = [env_fn() for env_fn in env_fns]
+        self.num_envs = len(self.envs)
+        assert self.num_envs > 0, 'SyncVectorEnv needs at least one env'
+        self.metadata = self.envs[0].metadata
+        self._obs = self._allocate_obs(self.envs[0].observation_spec())
+        self._rewards = np.empty(self.num_envs, dtype=np.float32)
+        self._dones = np.empty(self.num_envs, dtype=np.bool_)
+
+    def _allocate_obs(self, obs_spec):
+        obs = collections.OrderedDict()
+        for modality in obs_spec:
+            dtype = obs_dtype(modality)
+            modality_buffers = collections.OrderedDict()
+            for key, shape in obs_spec[modality].items():
+                modality_buffers[key] = np.empty((self.num_envs,) + tuple(shape),
+                                                 dtype=dtype)
+            obs[modality] = modality_buffers
+        return obs
+
+    def _write_obs(self, i, obs):
+        for modality, modality_buffers in self._obs.items():
+            for key, buffer in modality_buffers.items():
+                buffer[i] = obs[modality][key]
+
+    def _reset(self):
+        infos = []
+        for i, env in enumerate(self.envs):
+            obs, info = env.reset()
+            self._write_obs(i, obs)
+            infos.append(info)
+        return self._obs, infos
+
+    def _step(self, actions):
+        '''
+        Args:
+            actions: array of shape (N, action_dim)
+
+        Returns:
+            obs: nested dict of batched observations
+            rewards: numpy array of (N,)
+            dones: boolean numpy array of (N,)
+            infos: list of N info dicts
+            obs, rewards and dones are reused across steps, see the class
+            docstring
+        '''
+        infos = []
+        for i, env in enumerate(self.envs):
+            obs, reward, done, info = env.step(actions[i])
+            if done:
+                obs, _ = env.reset()
+            self._write_obs(i, obs)
+            self._rewards[i] = reward
+            self._dones[i] = done
+            infos.append(info)
+        return self._obs, self._rewards, self._dones, infos
+
+    def _close(self):
+        for env in self.envs:
+            env.close()
+
+    def observation_spec(self):
+        return self.envs[0].observation_spec()
+
+    def action_spec(self):
+        return self.envs[0].action_spec()
+
+    def __str__(self):
+        return '<{}{}x{}>'.format(type(self).__name__, self.num_envs, self.envs[0])
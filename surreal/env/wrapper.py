@@ -2,11 +2,18 @@ from .base import Env, ActionType, ObsType
 import numpy as np
 import surreal.utils as U
 import collections
-from collections import deque
-from operator import mul
-import functools
-import sys
+import copy
 import gym
+try:
+    # optional C extension, built by setup.py when a compiler is available
+    from . import _imgkernels
+except ImportError:
+    _imgkernels = None
+from . import _jit
+
+
+# Set to False to skip the double wrapping check when building many envs
+_CHECK_DOUBLE_WRAP = True
 
 
 class SpecFormat(U.StringEnum):
@@ -37,21 +44,15 @@ class Wrapper(Env):
         return cls.__name__
 
     def _ensure_no_double_wrap(self):
-        env = self.env
-        while True:
-            if isinstance(env, Wrapper):
-                if env.class_name() == self.class_name():
-                    raise RuntimeError(
-                        "Attempted to double wrap with Wrapper: {}"
-                        .format(self.__class__.__name__)
-                    )
-                env = env.env
-            else:
-                break
-
-    def step(self, action):
-        obs, reward, done, info = super().step(action)
-        return obs, reward, done, info
+        # Every wrapper records the class names of the wrappers below it
+        # (itself included), so the check does not walk the whole chain
+        inner_chain = getattr(self.env, '_wrapper_chain', frozenset())
+        if _CHECK_DOUBLE_WRAP and self.class_name() in inner_chain:
+            raise RuntimeError(
+                "Attempted to double wrap with Wrapper: {}"
+                .format(self.__class__.__name__)
+            )
+        self._wrapper_chain = inner_chain | {self.class_name()}
 
     def _step(self, action):
         return self.env.step(action)
@@ -168,6 +169,8 @@ class GymAdapter(Wrapper):
         assert not env_config.pixel_input, "Pixel input training not supported with OpenAI Gym"
         assert isinstance(env, gym.Env)
         self.env = env
+        self._obs_spec_cached = self._make_observation_spec()
+        self._action_spec_cached = self._make_action_spec()
 
     def _add_modality(self, obs):
         obs = {
@@ -185,6 +188,9 @@ class GymAdapter(Wrapper):
         return obs, reward, done, info
 
     def observation_spec(self):
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
         gym_spec = self.env.observation_space
         if isinstance(gym_spec, gym.spaces.Box):
             return self._add_modality(gym_spec.shape)
@@ -193,6 +199,9 @@ class GymAdapter(Wrapper):
         # TODO: migrate everything to dm_format
 
     def action_spec(self):
+        return self._action_spec_cached
+
+    def _make_action_spec(self):
         gym_spec = self.env.action_space
         if isinstance(gym_spec, gym.spaces.Box):
             return {
@@ -221,6 +230,8 @@ class RobosuiteWrapper(Wrapper):
         self.use_depth = env_config.use_depth and env_config.pixel_input
         self._input_list = env_config.observation
         self._action_repeat = env_config.action_repeat or 1
+        self._obs_spec_cached = self._make_observation_spec()
+        self._action_spec_cached = self._make_action_spec()
 
     def _add_modality(self, obs, verbose=False):
         pixel_modality = collections.OrderedDict()
@@ -271,6 +282,9 @@ class RobosuiteWrapper(Wrapper):
         return SpecFormat.MUJOCOMANIP
 
     def observation_spec(self):
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
         spec = self.env.observation_spec()
 
         if self.use_depth:
@@ -282,6 +296,9 @@ class RobosuiteWrapper(Wrapper):
         return self._add_modality(spec, verbose=True)
 
     def action_spec(self): # we haven't finalized the action spec of mujocomanip
+        return self._action_spec_cached
+
+    def _make_action_spec(self):
         return {'dim': (self.env.dof,), 'type': 'continuous'}
 
     def _render(self, *args, **kwargs):
@@ -292,19 +309,46 @@ class RobosuiteWrapper(Wrapper):
 
 
 class ObservationConcatenationWrapper(Wrapper):
-    def __init__(self, env, concatenated_obs_name='flat_inputs'):
+    def __init__(self, env, concatenated_obs_name='flat_inputs', dtype=np.float32):
+        '''
+        Args:
+            dtype: dtype of the concatenated observations. np.float16 halves
+                the size of the low_dim observations sent to the learner,
+                which converts them back to float32 per batch. Values
+                beyond +-65504 overflow in float16
+        '''
         super().__init__(env)
         self._concatenated_obs_name = concatenated_obs_name
+        self._dtype = np.dtype(dtype)
+        # Work out once where each low dimensional observation goes in the
+        # concatenated vector, so that stepping only copies the values over
+        self._flat_slices = []
+        self._flat_dim = 0
+        # (key, size) of the concatenated observations, in order
+        self.flat_keys = []
+        spec = self.env.observation_spec()
+        if 'low_dim' in spec:
+            for key, shape in spec['low_dim'].items():
+                assert len(shape) == 1
+                size = int(shape[0])
+                self._flat_slices.append((key, self._flat_dim, self._flat_dim + size))
+                self.flat_keys.append((key, size))
+                self._flat_dim += size
+        else:
+            # e.g. pixel only dm_control envs: nothing to concatenate,
+            # forward straight to the wrapped env
+            self._step = self.env.step
+            self._reset = self.env.reset
+        self._obs_spec_cached = self._make_observation_spec()
 
     def _flatten_obs(self, obs):
-        flat_observations = []
-        if 'low_dim' in obs:
-            for modality, v in obs['low_dim'].items():
-                flat_observations.append(v)
-            if len(flat_observations) > 0:
-                flat_observations = np.concatenate(flat_observations)
-                del obs['low_dim']
-                obs['low_dim'] = collections.OrderedDict([(self._concatenated_obs_name, flat_observations)])
+        low_dim = obs['low_dim']
+        # A new array every step, wrappers downstream (e.g. n-step
+        # experience senders) keep references to past observations
+        flat_observations = np.empty(self._flat_dim, dtype=self._dtype)
+        for key, start, end in self._flat_slices:
+            flat_observations[start:end] = low_dim[key]
+        obs['low_dim'] = collections.OrderedDict([(self._concatenated_obs_name, flat_observations)])
         return obs
 
     def _step(self, action):
@@ -320,13 +364,12 @@ class ObservationConcatenationWrapper(Wrapper):
         return SpecFormat.SURREAL_CLASSIC
 
     def observation_spec(self):
-        spec = self.env.observation_spec()
-        flat_observation_dim = 0
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        spec = copy.deepcopy(self.env.observation_spec())
         if 'low_dim' in spec:
-            for k, shape in spec['low_dim'].items():
-                assert len(shape) == 1
-                flat_observation_dim += shape[0]
-            spec['low_dim'] = collections.OrderedDict([(self._concatenated_obs_name, (flat_observation_dim,))])
+            spec['low_dim'] = collections.OrderedDict([(self._concatenated_obs_name, (self._flat_dim,))])
         return spec
 
     def action_spec(self):
@@ -336,6 +379,7 @@ class ObservationConcatenationWrapper(Wrapper):
 class TransposeWrapper(Wrapper):
     def __init__(self, env):
         super().__init__(env)
+        self._obs_spec_cached = self._make_observation_spec()
 
     def _transpose(self, obs):
         if 'pixel' in obs:
@@ -353,7 +397,10 @@ class TransposeWrapper(Wrapper):
         return self._transpose(obs), reward, done, info
 
     def observation_spec(self):
-        spec = self.env.observation_spec()
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        spec = copy.deepcopy(self.env.observation_spec())
         if 'pixel' in spec:
             for key in spec['pixel']:
                 H, W, C = spec['pixel'][key]
@@ -363,17 +410,62 @@ class TransposeWrapper(Wrapper):
         return spec
 
 
+def _luma(r, g, b, out, acc, tmp):
+    """
+    numpy version of the grayscale kernels in _jit: BT.601 luma
+    (77 * R + 150 * G + 29 * B) >> 8 in integer arithmetic,
+    256 * 255 still fits in the uint16 scratch buffers acc and tmp.
+    The result is written into the uint8 array out
+    """
+    np.multiply(r, 77, out=acc, dtype=np.uint16)
+    np.multiply(g, 150, out=tmp, dtype=np.uint16)
+    np.add(acc, tmp, out=acc)
+    np.multiply(b, 29, out=tmp, dtype=np.uint16)
+    np.add(acc, tmp, out=acc)
+    np.right_shift(acc, 8, out=out, casting='unsafe')
+    return out
+
+
 class GrayscaleWrapper(Wrapper):
     def __init__(self, env):
         super().__init__(env)
+        # numba is not needed when the C kernel is built
+        self._jit = _jit.load() if _imgkernels is None else None
+        # uint16 scratch buffers for the numpy code path, never handed out
+        # so they can be reused across steps
+        self._luma_bufs = {}
+        for key, (C, H, W) in self.env.observation_spec()['pixel'].items():
+            # For now, we expect an RGB image. Checked once here, the
+            # frames are not checked again at every step
+            assert C == 3
+            if self._jit is not None:
+                # compile ahead of the first step, frames coming out of
+                # TransposeWrapper are non-contiguous views
+                self._jit.grayscale(np.zeros((H, W, C), dtype=np.uint8).transpose((2, 0, 1)),
+                                    np.empty((H, W), dtype=np.uint8))
+            else:
+                self._luma_bufs[key] = (np.empty((H, W), dtype=np.uint16),
+                                        np.empty((H, W), dtype=np.uint16))
+        self._obs_spec_cached = self._make_observation_spec()
 
     def _grayscale(self, obs):
         for key in obs['pixel']:
             observation_modality = obs['pixel'][key]
-            C, H, W = observation_modality.shape
-            # For now, we expect an RGB image
-            assert C == 3
-            obs['pixel'][key] = np.mean(observation_modality, 0, 'uint8').reshape(1, H, W)
+            _, H, W = observation_modality.shape
+            gray = np.empty((H, W), dtype=np.uint8)
+            # frames coming out of TransposeWrapper are views of
+            # contiguous (H, W, 3) frames, which the C kernel takes as is
+            frame_hwc = observation_modality.transpose((1, 2, 0))
+            if (_imgkernels is not None and frame_hwc.flags.c_contiguous
+                    and frame_hwc.dtype == np.uint8):
+                _imgkernels.rgb_to_gray(frame_hwc, gray)
+            elif self._jit is not None:
+                self._jit.grayscale(observation_modality, gray)
+            else:
+                acc, tmp = self._luma_bufs[key]
+                _luma(observation_modality[0], observation_modality[1],
+                      observation_modality[2], gray, acc, tmp)
+            obs['pixel'][key] = gray.reshape(1, H, W)
         return obs
 
     def _step(self, action):
@@ -391,13 +483,14 @@ class GrayscaleWrapper(Wrapper):
         return SpecFormat.SURREAL_CLASSIC
 
     def observation_spec(self):
-        spec = self.env.observation_spec()
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        spec = copy.deepcopy(self.env.observation_spec())
         # TODO: make constant pixel_modality='pixel'
         for key in spec['pixel']:
             dimensions = spec['pixel'][key]
             C, H, W = dimensions
-            # We expect rgb for now
-            assert C == 3
             spec['pixel'][key] = (1, H, W)
         return spec
 
@@ -409,27 +502,45 @@ class FrameStackWrapper(Wrapper):
         super().__init__(env)
         self.n = env_config.frame_stacks
         self.frame_stack_concatenate_on_env = env_config.frame_stack_concatenate_on_env
-        self._history = deque(maxlen=self.n)
+        # ring buffers of the last n frames, allocated on reset
+        # once the frame dtype is known
+        self._rings = collections.OrderedDict()
+        self._write_idx = 0
+        self._jit = _jit.load()
+        if self._jit is not None:
+            for key, shape in self.env.observation_spec()['pixel'].items():
+                # compile ahead of the first step
+                ring = np.zeros((self.n,) + tuple(shape), dtype=np.uint8)
+                self._jit.stack_frames(ring[0], ring, 0, np.empty_like(ring))
+        else:
+            # row i holds the ring slots from oldest to newest when the
+            # newest frame is in slot i
+            self._gather_idx = (np.arange(self.n)[:, None]
+                                + np.arange(1, self.n + 1)) % self.n
+        self._obs_spec_cached = self._make_observation_spec()
 
     def _stacked_observation(self, obs):
         '''
-        Assumes self._history contains the last n frames from the environment
+        Adds obs to the history of the last n frames from the environment
         Concatenates the frames together along the depth axis
         '''
-        #stacked_obs_dict_unordered = collections.OrderedDict()
-        #stacked_obs_dict_unordered['pixel'] = collections.OrderedDict()
+        self._write_idx = (self._write_idx + 1) % self.n
         new_pixel_modality = collections.OrderedDict()
 
         for key in obs['pixel']:
-            obs_stacked = []
-            for history_obs in self._history:
-                obs_stacked.append(history_obs['pixel'][key])
-            assert len(obs_stacked) <= self.n
+            ring = self._rings[key]
+            # A new array every step, wrappers downstream keep
+            # references to past observations
+            obs_stacked = np.empty_like(ring)
+            if self._jit is not None:
+                self._jit.stack_frames(obs['pixel'][key], ring, self._write_idx, obs_stacked)
+            else:
+                ring[self._write_idx] = obs['pixel'][key]
+                np.take(ring, self._gather_idx[self._write_idx], axis=0, out=obs_stacked)
             if self.frame_stack_concatenate_on_env:
-                stacked = np.concatenate(obs_stacked, axis=0)
+                stacked = obs_stacked.reshape((-1,) + obs_stacked.shape[2:])
             else:
-                stacked = obs_stacked
-            #stacked_obs_dict_unordered['pixel'][key] = stacked
+                stacked = list(obs_stacked)
             new_pixel_modality[key] = stacked
         next_stacked_dict = collections.OrderedDict()
         for key in obs:
@@ -441,14 +552,15 @@ class FrameStackWrapper(Wrapper):
 
     def _step(self, action):
         obs_next, reward, done, info = self.env.step(action)
-        self._history.append(obs_next)
         obs_next_stacked = self._stacked_observation(obs_next)
         return obs_next_stacked, reward, done, info
 
     def _reset(self):
         obs, info = self.env.reset()
-        for i in range(self.n):
-            self._history.append(obs)
+        for key, frame in obs['pixel'].items():
+            self._rings[key] = np.empty((self.n,) + frame.shape, dtype=frame.dtype)
+        for i in range(self.n - 1):
+            self._stacked_observation(obs)
         a = self._stacked_observation(obs)
         return a, info
 
@@ -457,7 +569,10 @@ class FrameStackWrapper(Wrapper):
         return SpecFormat.SURREAL_CLASSIC
 
     def observation_spec(self):
-        spec = self.env.observation_spec()
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        spec = copy.deepcopy(self.env.observation_spec())
         if 'pixel' in spec:
             for key in spec['pixel']:
                 dimensions = spec['pixel'][key]
@@ -471,6 +586,96 @@ class FrameStackWrapper(Wrapper):
     def action_spec(self):
         return self.env.action_spec()
 
+class FusedPixelPipeline(Wrapper):
+    '''
+    Does the work of TransposeWrapper, GrayscaleWrapper and
+    FrameStackWrapper (with frame_stack_concatenate_on_env) in one pass:
+    each rendered (H, W, 3) frame is converted to grayscale straight
+    into a ring buffer of the last n frames, which are then copied out
+    as a (n, H, W) observation. The transpose is not needed since the
+    channel axis is reduced away.
+    Produces the same observations as the three separate wrappers, which
+    remain available through env_config.use_fused_pixel_pipeline = False
+    '''
+    def __init__(self, env, env_config):
+        super().__init__(env)
+        self.n = env_config.frame_stacks
+        self._write_idx = 0
+        self._rings = collections.OrderedDict()
+        self._luma_bufs = {}
+        # numba is not needed when the C kernel is built
+        self._jit = _jit.load() if _imgkernels is None else None
+        for key, (H, W, C) in self.env.observation_spec()['pixel'].items():
+            # For now, we expect an RGB image
+            assert C == 3
+            self._rings[key] = np.zeros((self.n, H, W), dtype=np.uint8)
+            if self._jit is not None:
+                # compile ahead of the first step
+                ring = self._rings[key]
+                self._jit.gray_and_stack(np.zeros((H, W, C), dtype=np.uint8),
+                                         ring, 0, np.empty_like(ring))
+            else:
+                self._luma_bufs[key] = (np.empty((H, W), dtype=np.uint16),
+                                        np.empty((H, W), dtype=np.uint16))
+        self._obs_spec_cached = self._make_observation_spec()
+
+    def _push_frames(self, frames):
+        '''
+        Adds the newest frame of every pixel key to the ring buffers
+        Returns the last n grayscale frames of every key, oldest first
+        '''
+        self._write_idx = (self._write_idx + 1) % self.n
+        stacked_frames = collections.OrderedDict()
+        for key, frame in frames.items():
+            ring = self._rings[key]
+            # A new array every step, wrappers downstream keep
+            # references to past observations
+            stacked = np.empty_like(ring)
+            if self._jit is not None:
+                self._jit.gray_and_stack(frame, ring, self._write_idx, stacked)
+            else:
+                if (_imgkernels is not None and frame.flags.c_contiguous
+                        and frame.dtype == np.uint8):
+                    _imgkernels.rgb_to_gray(frame, ring[self._write_idx])
+                else:
+                    acc, tmp = self._luma_bufs[key]
+                    _luma(frame[..., 0], frame[..., 1], frame[..., 2],
+                          ring[self._write_idx], acc, tmp)
+                oldest = self._write_idx + 1
+                stacked[:self.n - oldest] = ring[oldest:]
+                stacked[self.n - oldest:] = ring[:oldest]
+            stacked_frames[key] = stacked
+        return stacked_frames
+
+    def _step(self, action):
+        obs_next, reward, done, info = self.env.step(action)
+        obs_next['pixel'] = self._push_frames(obs_next['pixel'])
+        return obs_next, reward, done, info
+
+    def _reset(self):
+        obs, info = self.env.reset()
+        for i in range(self.n - 1):
+            self._push_frames(obs['pixel'])
+        obs['pixel'] = self._push_frames(obs['pixel'])
+        return obs, info
+
+    @property
+    def spec_format(self):
+        return SpecFormat.SURREAL_CLASSIC
+
+    def observation_spec(self):
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        spec = copy.deepcopy(self.env.observation_spec())
+        for key in spec['pixel']:
+            H, W, C = spec['pixel'][key]
+            spec['pixel'][key] = (self.n, H, W)
+        return spec
+
+    def action_spec(self):
+        return self.env.action_spec()
+
 class FilterWrapper(Wrapper):
     '''
     Given the inputs allowed in env_config.observation, reject any inputs
@@ -479,6 +684,7 @@ class FilterWrapper(Wrapper):
     def __init__(self, env, env_config):
         super().__init__(env)
         self._allowed_items = env_config.observation
+        self._obs_spec_cached = self._make_observation_spec()
 
     def _filtered_obs(self, obs, verbose=False):
         filtered = collections.OrderedDict()
@@ -506,8 +712,10 @@ class FilterWrapper(Wrapper):
         return SpecFormat.SURREAL_CLASSIC
 
     def observation_spec(self):
-        spec = self.env.observation_spec()
-        return self._filtered_obs(spec, verbose=True)
+        return self._obs_spec_cached
+
+    def _make_observation_spec(self):
+        return self._filtered_obs(self.env.observation_spec(), verbose=True)
 
     def action_spec(self):
         return self.env.action_spec()
@@ -1,10 +1,13 @@
+import inspect
+import io
+import os
 import pickle
+import re
 import sys
 import time
 import argparse
 from os import path
-
-from glob import glob
+import numpy as np
 
 from surreal.env import *
 import surreal.utils as U
@@ -12,13 +15,116 @@ from surreal.agent import PPOAgent, DDPGAgent
 
 from benedict import BeneDict
 
-def restore_model(folder, filename):
+# <name>.<global_steps>.ckpt, best-<global_steps> copies do not match
+_CKPT_RE = re.compile(r'^.+\.(\d+)\.ckpt$')
+
+class CheckpointUnpickler(pickle.Unpickler):
+    """
+    Unpickler that only resolves the globals Checkpoint._save_ckpt writes:
+    OrderedDicts, tensors and parameters, numpy arrays, optimizers and lr
+    schedulers. Any other global in the file raises an UnpicklingError
+    instead of being imported and called.
+    """
+    ALLOWED_GLOBALS = {
+        ('builtins', 'dict'),
+        ('builtins', 'set'),
+        ('builtins', 'frozenset'),
+        ('collections', 'OrderedDict'),
+        # Optimizer.state
+        ('collections', 'defaultdict'),
+        ('torch', 'Size'),
+        ('torch._utils', '_rebuild_tensor'),
+        ('torch._utils', '_rebuild_tensor_v2'),
+        ('torch._utils', '_rebuild_parameter'),
+        ('torch._utils', '_rebuild_parameter_with_state'),
+        ('torch._tensor', '_rebuild_from_type_v2'),
+        ('torch.nn.parameter', 'Parameter'),
+        ('numpy', 'ndarray'),
+        ('numpy', 'dtype'),
+        ('numpy.core.multiarray', '_reconstruct'),
+        ('numpy.core.multiarray', 'scalar'),
+        ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy._core.multiarray', 'scalar'),
+    }
+    # modules of the optimizer and lr scheduler classes
+    SCHEDULER_MODULES = ('torch.optim.', 'torchx.nn.')
+
+    def find_class(self, module, name):
+        if (module, name) in self.ALLOWED_GLOBALS:
+            return super().find_class(module, name)
+        if (module, name) == ('torch.storage', '_load_from_bytes'):
+            # the original calls torch.load without any restriction
+            return _load_storage_from_bytes
+        if module in ('torch', 'torch.storage') and name.endswith('Storage'):
+            return super().find_class(module, name)
+        if module == 'torch':
+            import torch
+            dtype = getattr(torch, name, None)
+            if isinstance(dtype, torch.dtype):
+                return dtype
+        if module.startswith(self.SCHEDULER_MODULES):
+            import torch
+            lr_scheduler = torch.optim.lr_scheduler
+            scheduler_base = getattr(lr_scheduler, 'LRScheduler',
+                                     lr_scheduler._LRScheduler)
+            cls = super().find_class(module, name)
+            if (isinstance(cls, type)
+                    and issubclass(cls, (torch.optim.Optimizer, scheduler_base))):
+                return cls
+        raise pickle.UnpicklingError(
+            'Checkpoint refers to {}.{}, which is not allowed'.format(module, name))
+
+class _CheckpointPickleModule:
+    """
+    pickle_module for torch.load versions without weights_only
+    """
+    Unpickler = CheckpointUnpickler
+
+    @staticmethod
+    def load(fp, **kwargs):
+        return CheckpointUnpickler(fp, **kwargs).load()
+
+def _load_storage_from_bytes(b):
+    """
+    Loads a pickled tensor storage, the bytes are a torch.save archive
+    """
+    import torch
+    if 'weights_only' in inspect.signature(torch.load).parameters:
+        return torch.load(io.BytesIO(b), weights_only=True)
+    return torch.load(io.BytesIO(b), pickle_module=_CheckpointPickleModule)
+
+def latest_checkpoint(folder):
+    """
+    Finds the checkpoint with the most global steps in an experiment
+    folder, using only the file names.
+
+    Returns:
+        file name of the checkpoint, None if there is none
+    """
+    latest, latest_steps = None, -1
+    for name in os.listdir(path.join(folder, "checkpoint")):
+        match = _CKPT_RE.match(name)
+        if match and int(match.group(1)) > latest_steps:
+            latest, latest_steps = name, int(match.group(1))
+    return latest
+
+def restore_model(folder, filename=None):
     """
     Loads model from an experiment folder.
+
+    Args:
+        folder: experiment folder
+        filename: checkpoint file name in folder/checkpoint,
+            None for the latest checkpoint
     """
+    if filename is None:
+        filename = latest_checkpoint(folder)
+        if filename is None:
+            raise FileNotFoundError('No checkpoint found in {}'
+                                    .format(path.join(folder, "checkpoint")))
     path_to_ckpt = path.join(folder, "checkpoint", filename)
     with open(path_to_ckpt, 'rb') as fp:
-        data = pickle.load(fp)
+        data = CheckpointUnpickler(fp).load()
     return data['model']
 
 def restore_config(path_to_config):
@@ -28,6 +134,25 @@ def restore_config(path_to_config):
     configs = BeneDict.load_yaml_file(path_to_config)
     return configs
 
+def restore_env(env_config):
+    """
+    Creates an evaluation environment from a config.
+    """
+    return make_env(env_config, mode='eval')
+
+def restore_flat_keys(env_config):
+    """
+    (key, size) of the low_dim observations in the order the restored
+    env concatenates them into 'flat_inputs'
+    """
+    env = restore_env(env_config)[0]
+    wrapped = env
+    while not isinstance(wrapped, ObservationConcatenationWrapper):
+        wrapped = wrapped.env
+    flat_keys = wrapped.flat_keys
+    env.close()
+    return flat_keys
+
 def restore_agent(agent_class, learner_config, env_config, session_config, render):
     """
     Restores an agent from a model.
@@ -42,19 +167,103 @@ def restore_agent(agent_class, learner_config, env_config, session_config, rende
     )
     return agent
 
+def run_segment(agent, env, obs, episode_rewards, steps):
+    """
+    Steps a vectorized environment with batched actions from the agent
+    for a fixed number of steps, printing the reward of every episode
+    that finishes.
+
+    Args:
+        agent: agent implementing act_batch() and reset_batch()
+        env: SyncVectorEnv or AsyncVectorEnv
+        obs: current batched observations
+        episode_rewards: numpy array of (num_envs,), running episode
+            rewards, updated in place
+        steps: number of vectorized steps to run
+
+    Returns:
+        the batched observations after the last step
+    """
+    for _ in range(steps):
+        actions = agent.act_batch(obs)
+        obs, rewards, dones, _ = env.step(actions)
+        episode_rewards += rewards
+        for i in np.flatnonzero(dones):
+            print('Env {} episode reward {}'.format(i, episode_rewards[i]))
+            episode_rewards[i] = 0
+        agent.reset_batch(dones)
+    return obs
+
+def rollout_vectorized(agent, env_config, num_envs, compile_policy=False,
+                       segment_steps=200, use_envpool=False, envs_per_process=0):
+    """
+    Runs the agent on several copies of the environment in lockstep,
+    with one batched forward pass of the policy per step.
+    With use_envpool, low dimensional dm_control envs are stepped by
+    envpool instead of the make_env wrapper chain.
+    With envs_per_process > 0, the envs are stepped in worker processes
+    by an AsyncVectorEnv, envs_per_process of them per worker.
+    """
+    if use_envpool:
+        # make_env fills in env_config.obs_spec/action_spec when restoring
+        # the agent, EnvPoolAdapter has to produce the same specs
+        env = EnvPoolAdapter(env_config, num_envs)
+        # the policy was trained on observations concatenated in the
+        # order of the make_env wrapper chain, envpool has its own order
+        expected_keys = restore_flat_keys(env_config)
+        assert env.flat_keys == expected_keys, \
+            'envpool observations {} do not match {}'.format(env.flat_keys,
+                                                             expected_keys)
+    else:
+        env_fns = [lambda: agent.prepare_env(restore_env(env_config)[0])
+                   for _ in range(num_envs)]
+        if envs_per_process > 0:
+            env = AsyncVectorEnv(env_fns, env_config.obs_spec, envs_per_process)
+        else:
+            env = SyncVectorEnv(env_fns)
+    if compile_policy:
+        agent.compile_policy()
+    obs, _ = env.reset()
+    episode_rewards = np.zeros(num_envs)
+    while True:
+        start = time.time()
+        obs = run_segment(agent, env, obs, episode_rewards, segment_steps)
+        print('{:.1f} env steps/s'.format(
+            segment_steps * num_envs / (time.time() - start)))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--folder", type=str, required=True)
-    parser.add_argument("--checkpoint", type=str, required=True)
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="checkpoint file name, defaults to the latest one")
     parser.add_argument("--algo", type=str, required=True)
     parser.add_argument("--render", action='store_true',)
     parser.add_argument("--record", action='store_true',)
     parser.add_argument("--record-every", type=int,)
     parser.add_argument("--record-folder", type=str,)
+    parser.add_argument("--num-envs", type=int, default=1)
+    parser.add_argument("--compile", action='store_true',
+                        help="torch.compile the policy, requires --num-envs > 1")
+    parser.add_argument("--use-envpool", action='store_true',
+                        help="step low_dim dm_control envs with envpool, "
+                             "requires --num-envs > 1")
+    parser.add_argument("--envs-per-process", type=int, default=0,
+                        help="step the envs in worker processes, this many "
+                             "per process, requires --num-envs > 1")
     args = parser.parse_args()
 
     if args.record and args.record_folder is None:
         parser.error("--record requires --record-folder")
+    if args.num_envs > 1 and (args.render or args.record):
+        parser.error("--render and --record require --num-envs 1")
+    if args.compile and args.num_envs == 1:
+        parser.error("--compile requires --num-envs > 1")
+    if args.use_envpool and args.num_envs == 1:
+        parser.error("--use-envpool requires --num-envs > 1")
+    if args.envs_per_process > 0 and args.num_envs == 1:
+        parser.error("--envs-per-process requires --num-envs > 1")
+    if args.envs_per_process > 0 and args.use_envpool:
+        parser.error("--envs-per-process and --use-envpool are exclusive")
 
     folder = args.folder
     checkpoint = args.checkpoint
@@ -84,4 +293,10 @@ if __name__ == "__main__":
     agent = restore_agent(algo, learner_config, env_config, session_config, render)
     agent.model.load_state_dict(model)
 
-    agent.main()
+    if args.num_envs > 1:
+        rollout_vectorized(agent, env_config, args.num_envs,
+                           compile_policy=args.compile,
+                           use_envpool=args.use_envpool,
+                           envs_per_process=args.envs_per_process)
+    else:
+        agent.main()
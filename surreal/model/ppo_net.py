@@ -340,7 +340,7 @@ class PPOModel(nnx.Module):
         obs = torch.cat([ob for ob in obs_list if ob is not None], dim=-1)
 
         if self.rnn_config.if_rnn_policy:
-            obs = obs.view(1, 1, -1) # assume input is shape (1, obs_dim)
+            obs = obs.view(obs.size(0), 1, -1) # input is shape (batch_size, obs_dim)
             obs, cells = self.rnn_stem(obs, cells)
             
             # .detach() is necessary here to prevent overflow of memory
@@ -350,7 +350,7 @@ class PPOModel(nnx.Module):
             obs = obs.contiguous()  
             obs = obs.view(-1, self.rnn_config.rnn_hidden)
 
-        action = self.actor(obs) # shape (1, action_dim)
+        action = self.actor(obs) # shape (batch_size, action_dim)
         return action, cells
 
     def z_update(self, obs):
@@ -42,6 +42,13 @@ BASE_ENV_CONFIG = {
     'obs_spec': {},
     'frame_stacks': 1,
     'frame_stack_concatenate_on_env': True,
+    # grayscale + frame stacking in a single wrapper, set to False to use
+    # the separate Transpose/Grayscale/FrameStack wrappers instead
+    'use_fused_pixel_pipeline': True,
+    # dtype of the concatenated low_dim observations, 'float16' halves
+    # their size on the way to the learner. SyncVectorEnv/AsyncVectorEnv
+    # batch them as float32 anyways, no saving for vectorized rollouts
+    'flat_obs_dtype': 'float32',
     # 'action_spec': {
     #     'dim': '_list_',
     #     'type': '_enum[continuous, discrete]_'
@@ -0,0 +1,448 @@
+import collections
+import copy
+import functools
+import sys
+import types
+import numpy as np
+import pytest
+from surreal.env.base import Env
+from surreal.env.wrapper import (TransposeWrapper, GrayscaleWrapper,
+                                 FrameStackWrapper, FusedPixelPipeline,
+                                 ObservationConcatenationWrapper, _luma)
+from surreal.env.sync_vector_env import SyncVectorEnv
+from surreal.env.async_vector_env import AsyncVectorEnv
+from surreal.env.envpool_adapter import EnvPoolAdapter, envpool_task_id
+from surreal.env import _jit
+
+
+class FakeEnv(Env):
+    """
+    Returns make_obs(t) at step t of an episode, episodes end after
+    episode_length steps
+    """
+    def __init__(self, obs_spec, make_obs, episode_length=1000):
+        self.obs_spec = obs_spec
+        self.make_obs = make_obs
+        self.episode_length = episode_length
+        self.t = 0
+
+    def _reset(self):
+        self.t = 0
+        return self.make_obs(self.t), {}
+
+    def _step(self, action):
+        self.t += 1
+        return (self.make_obs(self.t), float(action[0]) + self.t,
+                self.t >= self.episode_length, {})
+
+    def observation_spec(self):
+        return copy.deepcopy(self.obs_spec)
+
+    def action_spec(self):
+        return {'dim': (1,), 'type': 'continuous'}
+
+
+def pixel_env(frames):
+    H, W, C = frames[0].shape
+    obs_spec = collections.OrderedDict([
+        ('pixel', collections.OrderedDict([('camera0', (H, W, C))])),
+    ])
+    def make_obs(t):
+        return collections.OrderedDict([
+            ('pixel', collections.OrderedDict([('camera0', frames[t])])),
+        ])
+    return FakeEnv(obs_spec, make_obs)
+
+
+def random_frames(num_frames, H, W, contiguous=True, seed=0):
+    rng = np.random.RandomState(seed)
+    frames = [rng.randint(0, 256, (H, W, 3)).astype(np.uint8)
+              for _ in range(num_frames)]
+    if not contiguous:
+        # rendered upside down, a view with negative strides
+        frames = [frame[::-1] for frame in frames]
+    return frames
+
+
+def reference_gray(frame):
+    frame = frame.astype(np.int32)
+    return ((77 * frame[..., 0] + 150 * frame[..., 1]
+             + 29 * frame[..., 2]) >> 8).astype(np.uint8)
+
+
+GRAY_SHAPES = [(1, 1), (3, 5), (13, 17), (84, 84)]
+
+
+@pytest.mark.parametrize('H, W', GRAY_SHAPES)
+def test_c_grayscale(H, W):
+    _imgkernels = pytest.importorskip('surreal.env._imgkernels')
+    frame, = random_frames(1, H, W)
+    gray = np.empty((H, W), dtype=np.uint8)
+    _imgkernels.rgb_to_gray(frame, gray)
+    assert np.array_equal(gray, reference_gray(frame))
+
+
+def test_c_grayscale_checks_arrays():
+    _imgkernels = pytest.importorskip('surreal.env._imgkernels')
+    frame, = random_frames(1, 4, 4)
+    gray = np.empty((4, 4), dtype=np.uint8)
+    # only C-contiguous uint8 frames are accepted
+    with pytest.raises((ValueError, BufferError)):
+        _imgkernels.rgb_to_gray(frame[::-1], gray)
+    with pytest.raises(ValueError):
+        _imgkernels.rgb_to_gray(frame.astype(np.uint16), gray)
+    with pytest.raises(ValueError):
+        _imgkernels.rgb_to_gray(frame, gray[:-1])
+
+
+
+@pytest.mark.parametrize('contiguous', [True, False])
+def test_grayscale_wrapper(contiguous):
+    # contiguous frames go through the C kernel when it is built,
+    # the others through numba or numpy
+    frames = random_frames(4, 13, 17, contiguous)
+    env = GrayscaleWrapper(TransposeWrapper(pixel_env(frames)))
+    assert env.observation_spec()['pixel']['camera0'] == (1, 13, 17)
+    observations = [env.reset()[0]] + [env.step([0])[0] for _ in range(3)]
+    for t, obs in enumerate(observations):
+        assert np.array_equal(obs['pixel']['camera0'][0], reference_gray(frames[t]))
+
+
+def counting_env(episode_length):
+    obs_spec = collections.OrderedDict([
+        ('pixel', collections.OrderedDict([('camera0', (1, 2, 2))])),
+        ('low_dim', collections.OrderedDict([('flat_inputs', (3,))])),
+    ])
+    def make_obs(t):
+        return collections.OrderedDict([
+            ('pixel', collections.OrderedDict([
+                ('camera0', np.full((1, 2, 2), t, dtype=np.uint8))])),
+            ('low_dim', collections.OrderedDict([
+                ('flat_inputs', np.arange(3.) + t)])),
+        ])
+    return FakeEnv(obs_spec, make_obs, episode_length)
+
+
+def check_auto_reset(vector_env, num_steps=7):
+    """
+    Steps a vector env of counting_env(2 + i), i = 0..4
+    """
+    obs, _ = vector_env.reset()
+    assert obs['pixel']['camera0'].dtype == np.uint8
+    assert obs['low_dim']['flat_inputs'].dtype == np.float32
+    assert list(obs['low_dim']['flat_inputs'][:, 0]) == [0] * 5
+    steps = np.zeros(5, dtype=np.int64)
+    for _ in range(num_steps):
+        actions = np.arange(5, dtype=np.float32).reshape(5, 1)
+        obs, rewards, dones, infos = vector_env.step(actions)
+        steps += 1
+        expected_dones = steps >= 2 + np.arange(5)
+        expected_rewards = np.arange(5) + steps
+        # finished envs are reset, their observation is the first one
+        # of the new episode
+        steps[expected_dones] = 0
+        assert list(obs['pixel']['camera0'][:, 0, 0, 0]) == list(steps)
+        assert list(obs['low_dim']['flat_inputs'][:, 0]) == list(steps)
+        assert np.array_equal(rewards, expected_rewards)
+        assert np.array_equal(dones, expected_dones)
+        assert len(infos) == 5
+
+
+def test_sync_vector_env_auto_reset():
+    env = SyncVectorEnv([functools.partial(counting_env, 2 + i) for i in range(5)])
+    try:
+        check_auto_reset(env)
+    finally:
+        env.close()
+
+
+@pytest.mark.parametrize('envs_per_process', [1, 2, 5])
+def test_async_vector_env_auto_reset(envs_per_process):
+    env_fns = [functools.partial(counting_env, 2 + i) for i in range(5)]
+    env = AsyncVectorEnv(env_fns, counting_env(1).observation_spec(),
+                         envs_per_process=envs_per_process)
+    try:
+        assert env.num_processes == -(-5 // envs_per_process)
+        check_auto_reset(env)
+    finally:
+        env.close()
+
+
+class BrokenEnv(FakeEnv):
+    def __init__(self):
+        raise ValueError('cannot create env')
+
+
+def test_async_vector_env_worker_failure():
+    env_fns = [functools.partial(counting_env, 2), BrokenEnv]
+    with pytest.raises(RuntimeError):
+        AsyncVectorEnv(env_fns, counting_env(1).observation_spec())
+
+
+def numba_kernels():
+    kernels = _jit.load()
+    if kernels is None:
+        pytest.skip('numba is not installed')
+    return kernels
+
+
+@pytest.mark.parametrize('H, W', GRAY_SHAPES)
+@pytest.mark.parametrize('contiguous', [True, False])
+def test_numba_grayscale(H, W, contiguous):
+    kernels = numba_kernels()
+    frame, = random_frames(1, H, W, contiguous)
+    gray = np.empty((H, W), dtype=np.uint8)
+    kernels.grayscale(frame.transpose((2, 0, 1)), gray)
+    assert np.array_equal(gray, reference_gray(frame))
+
+
+def test_numba_stack_frames():
+    kernels = numba_kernels()
+    ring = np.zeros((3, 1, 2, 2), dtype=np.uint8)
+    out = np.empty_like(ring)
+    for t in range(1, 6):
+        kernels.stack_frames(np.full((1, 2, 2), t, dtype=np.uint8), ring, t % 3, out)
+        assert list(out[:, 0, 0, 0]) == [max(0, t - 2 + i) for i in range(3)]
+
+
+
+@pytest.mark.parametrize('contiguous', [True, False])
+def test_numba_gray_and_stack(contiguous):
+    kernels = numba_kernels()
+    frames = random_frames(5, 13, 17, contiguous)
+    ring = np.zeros((3, 13, 17), dtype=np.uint8)
+    out = np.empty_like(ring)
+    for t, frame in enumerate(frames):
+        kernels.gray_and_stack(frame, ring, t % 3, out)
+        expected = [reference_gray(frames[t - 2 + i]) if t - 2 + i >= 0
+                    else np.zeros((13, 17), dtype=np.uint8) for i in range(3)]
+        assert np.array_equal(out, np.stack(expected))
+
+
+@pytest.mark.parametrize('contiguous', [True, False])
+def test_fused_pixel_pipeline(contiguous):
+    frames = random_frames(8, 13, 17, contiguous)
+    env_config = types.SimpleNamespace(frame_stacks=3,
+                                       frame_stack_concatenate_on_env=True)
+    fused = FusedPixelPipeline(pixel_env(frames), env_config)
+    chain = FrameStackWrapper(GrayscaleWrapper(TransposeWrapper(
+        pixel_env(frames))), env_config)
+    assert fused.observation_spec() == chain.observation_spec()
+    fused_obs = [fused.reset()[0]] + [fused.step([0])[0] for _ in range(7)]
+    chain_obs = [chain.reset()[0]] + [chain.step([0])[0] for _ in range(7)]
+    for t in range(8):
+        expected = np.stack([reference_gray(frames[max(0, t - 2 + i)])
+                             for i in range(3)])
+        assert np.array_equal(fused_obs[t]['pixel']['camera0'], expected)
+        assert np.array_equal(chain_obs[t]['pixel']['camera0'], expected)
+
+
+@pytest.mark.parametrize('H, W', GRAY_SHAPES)
+@pytest.mark.parametrize('contiguous', [True, False])
+def test_luma(H, W, contiguous):
+    frame, = random_frames(1, H, W, contiguous)
+    gray = np.empty((H, W), dtype=np.uint8)
+    acc = np.empty((H, W), dtype=np.uint16)
+    tmp = np.empty((H, W), dtype=np.uint16)
+    _luma(frame[..., 0], frame[..., 1], frame[..., 2], gray, acc, tmp)
+    assert np.array_equal(gray, reference_gray(frame))
+    # no uint16 overflow on white
+    white = np.full((H, W, 3), 255, dtype=np.uint8)
+    _luma(white[..., 0], white[..., 1], white[..., 2], gray, acc, tmp)
+    assert (gray == 255).all()
+
+
+def low_dim_env():
+    obs_spec = collections.OrderedDict([
+        ('low_dim', collections.OrderedDict([
+            ('position', (3,)), ('velocity', (2,)), ('height', (1,))])),
+        ('pixel', collections.OrderedDict([('camera0', (1, 2, 2))])),
+    ])
+    def make_obs(t):
+        return collections.OrderedDict([
+            ('low_dim', collections.OrderedDict([
+                ('position', np.array([1., 2., 3.]) + t),
+                ('velocity', np.array([4., 5.]) + t),
+                ('height', np.array([6.]) + t)])),
+            ('pixel', collections.OrderedDict([
+                ('camera0', np.full((1, 2, 2), t, dtype=np.uint8))])),
+        ])
+    return FakeEnv(obs_spec, make_obs)
+
+
+def test_observation_concatenation():
+    env = ObservationConcatenationWrapper(low_dim_env())
+    assert env.observation_spec()['low_dim'] == {'flat_inputs': (6,)}
+    assert env.observation_spec()['pixel'] == {'camera0': (1, 2, 2)}
+    assert env.flat_keys == [('position', 3), ('velocity', 2), ('height', 1)]
+    obs, _ = env.reset()
+    first = obs['low_dim']['flat_inputs']
+    # float64 observations are stored as float32 by default
+    assert first.dtype == np.float32
+    assert list(first) == [1., 2., 3., 4., 5., 6.]
+    assert list(obs['low_dim']) == ['flat_inputs']
+    assert obs['pixel']['camera0'][0, 0, 0] == 0
+    obs, _, _, _ = env.step([0])
+    assert list(obs['low_dim']['flat_inputs']) == [2., 3., 4., 5., 6., 7.]
+    # observations handed out earlier are not overwritten
+    assert list(first) == [1., 2., 3., 4., 5., 6.]
+
+
+def test_observation_concatenation_dtype():
+    env = ObservationConcatenationWrapper(low_dim_env(), dtype=np.float16)
+    obs, _ = env.reset()
+    assert obs['low_dim']['flat_inputs'].dtype == np.float16
+    assert list(obs['low_dim']['flat_inputs']) == [1., 2., 3., 4., 5., 6.]
+
+
+def test_observation_concatenation_pixel_only():
+    frames = random_frames(3, 4, 4)
+    inner = pixel_env(frames)
+    env = ObservationConcatenationWrapper(inner)
+    assert env.flat_keys == []
+    assert env.observation_spec() == inner.observation_spec()
+    obs, _ = env.reset()
+    assert obs['pixel']['camera0'] is frames[0]
+    obs, _, _, _ = env.step([0])
+    assert obs['pixel']['camera0'] is frames[1]
+
+
+def test_vector_env_reuses_arrays():
+    env_fns = [functools.partial(counting_env, 2 + i) for i in range(3)]
+    obs_spec = counting_env(1).observation_spec()
+    for env in [SyncVectorEnv(env_fns), AsyncVectorEnv(env_fns, obs_spec)]:
+        try:
+            obs, _ = env.reset()
+            actions = np.zeros((3, 1), dtype=np.float32)
+            _, rewards, dones, _ = env.step(actions)
+            for _ in range(3):
+                next_obs, next_rewards, next_dones, _ = env.step(actions)
+                assert next_obs['pixel']['camera0'] is obs['pixel']['camera0']
+                assert next_obs['low_dim']['flat_inputs'] is obs['low_dim']['flat_inputs']
+                assert next_rewards is rewards
+                assert next_dones is dones
+        finally:
+            env.close()
+
+
+@pytest.mark.parametrize('concatenate', [True, False])
+def test_frame_stack_order(concatenate):
+    frames = [np.full((1, 2, 2), t, dtype=np.uint8) for t in range(8)]
+    obs_spec = collections.OrderedDict([
+        ('pixel', collections.OrderedDict([('camera0', (1, 2, 2))])),
+    ])
+    def make_obs(t):
+        return collections.OrderedDict([
+            ('pixel', collections.OrderedDict([('camera0', frames[t])])),
+        ])
+    env_config = types.SimpleNamespace(frame_stacks=3,
+                                       frame_stack_concatenate_on_env=concatenate)
+    env = FrameStackWrapper(FakeEnv(obs_spec, make_obs), env_config)
+    assert env.observation_spec()['pixel']['camera0'] == (3, 2, 2)
+    observations = [env.reset()[0]] + [env.step([0])[0] for _ in range(7)]
+    # checked after all steps: observations handed out earlier must not
+    # be overwritten by the ring buffer
+    for t, obs in enumerate(observations):
+        stacked = obs['pixel']['camera0']
+        if not concatenate:
+            assert len(stacked) == 3
+            stacked = np.concatenate(stacked)
+        assert stacked.shape == (3, 2, 2)
+        assert list(stacked[:, 0, 0]) == [max(0, t - 2 + i) for i in range(3)]
+
+
+class FakeEnvPool:
+    """
+    Stands in for an envpool dm_control pool: observations come as a
+    namedtuple in envpool's field order, first steps of episodes have
+    NaN rewards. Episodes last 3 steps, after which the next step
+    resets the env
+    """
+    Observation = collections.namedtuple('Observation',
+                                         'env_id height position velocity')
+    Spec = collections.namedtuple('Spec', 'shape')
+
+    def __init__(self, task_id, env_type, num_envs):
+        assert env_type == 'dm'
+        self.task_id = task_id
+        self.num_envs = num_envs
+        self.t = np.zeros(num_envs, dtype=np.int64)
+
+    def observation_spec(self):
+        return self.Observation(self.Spec(()), self.Spec(()),
+                                self.Spec((3,)), self.Spec((2, 2)))
+
+    def action_spec(self):
+        return self.Spec((6,))
+
+    def _timestep(self, reward):
+        t = self.t.astype(np.float64)
+        observation = self.Observation(
+            np.arange(self.num_envs), 100 + t,
+            np.stack([t, t + 1, t + 2], axis=1),
+            np.tile(t[:, None, None], (1, 2, 2)) + 10)
+        last = self.t == 3
+        return types.SimpleNamespace(observation=observation, reward=reward,
+                                     last=lambda: last)
+
+    def reset(self):
+        self.t[:] = 0
+        return self._timestep(np.full(self.num_envs, np.nan))
+
+    def step(self, actions):
+        assert actions.shape == (self.num_envs, 6)
+        restarted = self.t == 3
+        self.t += 1
+        self.t[restarted] = 0
+        reward = np.ones(self.num_envs)
+        reward[restarted] = np.nan
+        return self._timestep(reward)
+
+    def close(self):
+        pass
+
+
+def envpool_config(observations, pixel_input=False):
+    return types.SimpleNamespace(env_name='dm_control:ball_in_cup-catch',
+                                 pixel_input=pixel_input,
+                                 observation={'low_dim': observations})
+
+
+def test_envpool_task_id():
+    assert envpool_task_id('dm_control:cheetah-run') == 'CheetahRun-v1'
+    assert envpool_task_id('dm_control:ball_in_cup-catch') == 'BallInCupCatch-v1'
+    with pytest.raises(ValueError):
+        envpool_task_id('gym:HalfCheetah-v2')
+
+
+def test_envpool_adapter(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'envpool',
+                        types.SimpleNamespace(make=FakeEnvPool))
+    env = EnvPoolAdapter(envpool_config(['velocity', 'position']), 2)
+    assert env.task_id == 'BallInCupCatch-v1'
+    # envpool's field order, filtered by the config
+    assert env.flat_keys == [('position', 3), ('velocity', 4)]
+    assert env.observation_spec()['low_dim']['flat_inputs'] == (7,)
+    assert env.action_spec()['dim'] == (6,)
+    obs, infos = env.reset()
+    flat_inputs = obs['low_dim']['flat_inputs']
+    assert flat_inputs.shape == (2, 7) and flat_inputs.dtype == np.float32
+    assert list(flat_inputs[0]) == [0, 1, 2, 10, 10, 10, 10]
+    assert len(infos) == 2
+    actions = np.zeros((2, 6))
+    for t in [1, 2, 3, 0]:
+        obs, rewards, dones, infos = env.step(actions)
+        assert obs['low_dim']['flat_inputs'] is flat_inputs
+        assert list(flat_inputs[1]) == [t, t + 1, t + 2] + [t + 10] * 4
+        assert list(dones) == [t == 3] * 2
+        # the first step of an episode has no reward
+        assert list(rewards) == [0 if t == 0 else 1] * 2
+    env.close()
+
+
+def test_envpool_adapter_errors(monkeypatch):
+    with pytest.raises(ValueError):
+        EnvPoolAdapter(envpool_config([], pixel_input=True), 2)
+    monkeypatch.setitem(sys.modules, 'envpool', None)
+    with pytest.raises(ImportError):
+        EnvPoolAdapter(envpool_config(['position']), 2)
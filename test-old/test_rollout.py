@@ -0,0 +1,59 @@
+import io
+import os
+import pickle
+import collections
+import numpy as np
+import pytest
+from surreal.main.rollout import CheckpointUnpickler, latest_checkpoint
+
+
+class _Exploit:
+    def __init__(self, func, arg):
+        self.func = func
+        self.arg = arg
+
+    def __reduce__(self):
+        return self.func, (self.arg,)
+
+
+def _unpickle(data):
+    return CheckpointUnpickler(io.BytesIO(data)).load()
+
+
+def test_checkpoint_unpickler_loads_checkpoint():
+    data = collections.OrderedDict([
+        ('model', collections.OrderedDict([
+            ('weight', np.arange(6, dtype=np.float32).reshape(2, 3)),
+            ('bias', np.float64(0.5)),
+        ])),
+        ('state', collections.defaultdict(dict, {0: {'step': 3}})),
+        ('current_iteration', 12),
+    ])
+    restored = _unpickle(pickle.dumps(data))
+    assert list(restored) == ['model', 'state', 'current_iteration']
+    np.testing.assert_array_equal(restored['model']['weight'], data['model']['weight'])
+    assert restored['model']['bias'] == 0.5
+    assert restored['state'][0] == {'step': 3}
+    assert restored['current_iteration'] == 12
+
+
+@pytest.mark.parametrize('exploit', [
+    _Exploit(os.system, 'echo PWNED'),
+    _Exploit(np.testing._private.utils.runstring, 'print("PWNED")'),
+    _Exploit(eval, 'print("PWNED")'),
+])
+def test_checkpoint_unpickler_rejects_globals(exploit):
+    data = collections.OrderedDict([('model', exploit)])
+    with pytest.raises(pickle.UnpicklingError):
+        _unpickle(pickle.dumps(data))
+
+
+def test_latest_checkpoint(tmpdir):
+    folder = str(tmpdir)
+    os.makedirs(os.path.join(folder, 'checkpoint'))
+    assert latest_checkpoint(folder) is None
+    for name in ['learner.900.ckpt', 'learner.10000.ckpt',
+                 'learner.best-20000.ckpt', 'learner.ckpt.yml', 'learner.2000.ckpt']:
+        open(os.path.join(folder, 'checkpoint', name), 'w').close()
+    # compared as numbers, best-* copies are skipped
+    assert latest_checkpoint(folder) == 'learner.10000.ckpt'